@@ -6,16 +6,21 @@ import re
 import os
 import shutil
 import logging
+import hashlib
 
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 
 from prompts import SYSTEM_PROMPT, SYSTEM_PROMPT_TEXT_ONLY
 from openai import OpenAI
-from utils import get_web_element_rect, encode_image, extract_information, print_message,\
-    get_webarena_accessibility_tree, get_pdf_retrieval_ans_from_assistant, clip_message_and_obs, clip_message_and_obs_text_only
+from utils import get_web_element_rect, save_screenshot, compress_screenshot, extract_information, print_message,\
+    get_webarena_accessibility_tree, get_pdf_retrieval_ans_from_assistant, clip_message_and_obs, clip_message_and_obs_text_only,\
+    INPUT_ATTR_TYPES
 
 
 def setup_logger(folder_path):
@@ -55,39 +60,40 @@ def driver_config(args):
     return options
 
 
-def format_msg(it, init_msg, pdf_obs, warn_obs, web_img_b64, web_text):
+# shared by every observation that carries the set-of-mark element text
+WEB_TEXT_PROMPT = "I've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n"
+
+
+def format_msg(it, init_msg, pdf_obs, warn_obs, web_img_b64, web_text, img_type='png'):
+    img_part = {
+        'type': 'image_url',
+        'image_url': {"url": f"data:image/{img_type};base64,{web_img_b64}"}
+    }
     if it == 1:
-        init_msg += f"I've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n{web_text}"
+        init_msg += WEB_TEXT_PROMPT + web_text
         init_msg_format = {
             'role': 'user',
             'content': [
                 {'type': 'text', 'text': init_msg},
+                img_part
             ]
         }
-        init_msg_format['content'].append({"type": "image_url",
-                                           "image_url": {"url": f"data:image/png;base64,{web_img_b64}"}})
         return init_msg_format
     else:
         if not pdf_obs:
             curr_msg = {
                 'role': 'user',
                 'content': [
-                    {'type': 'text', 'text': f"Observation:{warn_obs} please analyze the attached screenshot and give the Thought and Action. I've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n{web_text}"},
-                    {
-                        'type': 'image_url',
-                        'image_url': {"url": f"data:image/png;base64,{web_img_b64}"}
-                    }
+                    {'type': 'text', 'text': f"Observation:{warn_obs} please analyze the attached screenshot and give the Thought and Action. {WEB_TEXT_PROMPT}{web_text}"},
+                    img_part
                 ]
             }
         else:
             curr_msg = {
                 'role': 'user',
                 'content': [
-                    {'type': 'text', 'text': f"Observation: {pdf_obs} Please analyze the response given by Assistant, then consider whether to continue iterating or not. The screenshot of the current page is also attached, give the Thought and Action. I've provided the tag name of each element and the text it contains (if text exists). Note that <textarea> or <input> may be textbox, but not exactly. Please focus more on the screenshot and then refer to the textual information.\n{web_text}"},
-                    {
-                        'type': 'image_url',
-                        'image_url': {"url": f"data:image/png;base64,{web_img_b64}"}
-                    }
+                    {'type': 'text', 'text': f"Observation: {pdf_obs} Please analyze the response given by Assistant, then consider whether to continue iterating or not. The screenshot of the current page is also attached, give the Thought and Action. {WEB_TEXT_PROMPT}{web_text}"},
+                    img_part
                 ]
             }
         return curr_msg
@@ -146,13 +152,9 @@ def call_gpt4v_api(args, openai_client, messages):
             elif type(e).__name__ == 'APIError':
                 time.sleep(15)
 
-            elif type(e).__name__ == 'InvalidRequestError':
-                gpt_call_error = True
-                return None, None, gpt_call_error, None
-
             else:
-                gpt_call_error = True
-                return None, None, gpt_call_error, None
+                # InvalidRequestError and anything unexpected are not retried
+                return None, None, True, None
 
         retry_times += 1
         if retry_times == 10:
@@ -161,9 +163,20 @@ def call_gpt4v_api(args, openai_client, messages):
 
 
 def exec_action_click(info, web_ele, driver_task):
-    driver_task.execute_script("arguments[0].setAttribute('target', '_self')", web_ele)
+    # the marker only survives while the current document does
+    driver_task.execute_script("arguments[0].setAttribute('target', '_self'); window.__aadb_nav = 1;", web_ele)
+    click_time = time.time()
     web_ele.click()
-    time.sleep(3)
+    # a navigation detaches the clicked element and drops the marker, then wait for the new page to load
+    # a re-render also detaches it without a new document, so keep the rest of the old 3 seconds
+    try:
+        WebDriverWait(driver_task, 3).until(EC.staleness_of(web_ele))
+        if driver_task.execute_script("return window.__aadb_nav === 1;"):
+            time.sleep(max(0, 3 - (time.time() - click_time)))
+        else:
+            WebDriverWait(driver_task, 10).until(lambda d: d.execute_script("return document.readyState") == "complete")
+    except TimeoutException:
+        pass
 
 
 def exec_action_type(info, web_ele, driver_task):
@@ -173,7 +186,7 @@ def exec_action_type(info, web_ele, driver_task):
     ele_tag_name = web_ele.tag_name.lower()
     ele_type = web_ele.get_attribute("type")
     # outer_html = web_ele.get_attribute("outerHTML")
-    if (ele_tag_name != 'input' and ele_tag_name != 'textarea') or (ele_tag_name == 'input' and ele_type not in ['text', 'search', 'password', 'email', 'tel']):
+    if (ele_tag_name != 'input' and ele_tag_name != 'textarea') or (ele_tag_name == 'input' and ele_type not in INPUT_ATTR_TYPES):
         warn_obs = f"note: The web element you're trying to type may not be a textbox, and its tag name is <{web_ele.tag_name}>, type is {ele_type}."
     try:
         # Not always work to delete
@@ -250,8 +263,13 @@ def main():
     parser.add_argument("--window_width", type=int, default=1024)
     parser.add_argument("--window_height", type=int, default=768)  # for headless mode, there is no address bar
     parser.add_argument("--fix_box_color", action='store_true')
+    parser.add_argument("--compress_screenshot", action='store_true', help='Send a downscaled JPEG screenshot to the API')
+    parser.add_argument("--skip_unchanged_obs", action='store_true', help='Send a short note instead of the screenshot when the page is unchanged')
 
     args = parser.parse_args()
+    # random box colors change every screenshot, so an unchanged page could never be detected
+    if args.skip_unchanged_obs:
+        args.fix_box_color = True
 
     # OpenAI client
     client = OpenAI(api_key=args.api_key)
@@ -315,6 +333,8 @@ def main():
         init_msg = init_msg + obs_prompt
 
         it = 0
+        last_web_state_hash = None  # to detect an unchanged page with --skip_unchanged_obs
+        action_key = None
         accumulate_prompt_token = 0
         accumulate_completion_token = 0
 
@@ -338,19 +358,32 @@ def main():
                     break
 
                 img_path = os.path.join(task_dir, 'screenshot{}.png'.format(it))
-                driver_task.save_screenshot(img_path)
+                b64_img = save_screenshot(driver_task, img_path, optimize_for_speed=args.compress_screenshot)
 
                 # accessibility tree
                 if (not args.text_only) and args.save_accessibility_tree:
                     accessibility_tree_path = os.path.join(task_dir, 'accessibility_tree{}'.format(it))
                     get_webarena_accessibility_tree(driver_task, accessibility_tree_path)
 
-                # encode image
-                b64_img = encode_image(img_path)
-
                 # format msg
                 if not args.text_only:
-                    curr_msg = format_msg(it, init_msg, pdf_obs, warn_obs, b64_img, web_eles_text)
+                    skip_obs = False
+                    if args.skip_unchanged_obs:
+                        # the screenshot covers input values, scroll position and non-labelled content
+                        web_state_hash = hashlib.blake2b((web_eles_text + b64_img).encode('utf-8'), digest_size=16).digest()
+                        # after typing or scrolling the model must always see the result
+                        skip_obs = not pdf_obs and action_key not in ['type', 'scroll'] and web_state_hash == last_web_state_hash
+                        last_web_state_hash = web_state_hash
+                    if skip_obs:
+                        # the previous screenshot is still attached in the context
+                        curr_msg = {
+                            'role': 'user',
+                            'content': f"Observation:{warn_obs} the webpage is unchanged since the last screenshot, please refer to it and give the Thought and Action."
+                        }
+                    elif args.compress_screenshot:
+                        curr_msg = format_msg(it, init_msg, pdf_obs, warn_obs, compress_screenshot(b64_img), web_eles_text, img_type='jpeg')
+                    else:
+                        curr_msg = format_msg(it, init_msg, pdf_obs, warn_obs, b64_img, web_eles_text)
                 else:
                     curr_msg = format_msg_text_only(it, init_msg, pdf_obs, warn_obs, ac_tree)
                 messages.append(curr_msg)
@@ -383,10 +416,9 @@ def main():
 
             # remove the rects on the website
             if (not args.text_only) and rects:
-                logging.info(f"Num of interactive elements: {len(rects)}")
-                for rect_ele in rects:
-                    driver_task.execute_script("arguments[0].remove()", rect_ele)
-                rects = []
+                logging.info(f"Num of interactive elements: {len(web_eles)}")
+                driver_task.execute_script("arguments[0].remove()", rects)
+                rects = None
                 # driver_task.save_screenshot(os.path.join(task_dir, 'screenshot{}_no_box.png'.format(it)))
 
 
@@ -403,6 +435,11 @@ def main():
             # print(chosen_action)
             action_key, info = extract_information(chosen_action)
 
+            # no observation follows the last iteration, so only an answer is worth executing
+            if it >= args.max_iter and action_key != 'answer':
+                logging.info('Reached max iterations, skip executing the last action.')
+                break
+
             fail_obs = ""
             pdf_obs = ""
             warn_obs = ""
@@ -1,16 +1,17 @@
 import base64
+import io
 import re
 import os
 import json
 import time
 import logging
-import numpy as np
-from PIL import Image
 from utils_webarena import fetch_browser_info, fetch_page_accessibility_tree,\
                     parse_accessibility_tree, clean_accesibility_tree
 
 
 def resize_image(image_path):
+    from PIL import Image
+
     image = Image.open(image_path)
     width, height = image.size
 
@@ -35,18 +36,30 @@ def encode_image(image_path):
         return base64.b64encode(image_file.read()).decode('utf-8')
 
 
-# interact with webpage and add rectangles on elements
-def get_web_element_rect(browser, fix_color=True):
-    if fix_color:
-        selected_function = "getFixedColor"
-        # color_you_like = '#5210da'
-    else:
-        selected_function = "getRandomColor"
+# save the screenshot for evaluation and reuse the driver's base64 payload for the API
+# captured over CDP (Chrome only, like the accessibility tree), optimize_for_speed trades PNG size for
+# encoding time and only pays off when the PNG is re-encoded before upload
+def save_screenshot(browser, img_path, optimize_for_speed=False):
+    b64_img = browser.execute_cdp_cmd("Page.captureScreenshot", {"format": "png", "optimizeForSpeed": optimize_for_speed})["data"]
+    with open(img_path, 'wb') as fw:
+        fw.write(base64.b64decode(b64_img))
+    return b64_img
 
-    js_script = """
-        let labels = [];
 
-        function markPage() {
+# downscaled JPEG for the API, several times smaller than the lossless PNG
+def compress_screenshot(b64_img, max_size=896, quality=85):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(base64.b64decode(b64_img))).convert('RGB')
+    image.thumbnail((max_size, max_size), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=quality, optimize=True)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+# Set-of-mark script, COLOR_FUNCTION is substituted once per color mode and cached
+MARK_PAGE_SCRIPT = """
+        function markPage(inputAttrTypes) {
             var bodyRect = document.body.getBoundingClientRect();
 
             var items = Array.prototype.slice.call(
@@ -86,7 +99,11 @@ def get_web_element_rect(browser, fix_color=True):
                 ,
                 area,
                 rects,
-                text: element.textContent.trim().replace(/\s{2,}/g, ' ')
+                text: element.textContent.trim().replace(/\s{2,}/g, ' '),
+                // same values as WebElement.tag_name / get_attribute, without a round trip per element
+                tagName: element.tagName.toLowerCase(),
+                type: element.type ?? element.getAttribute("type"),
+                ariaLabel: element.getAttribute("aria-label")
                 };
             }).filter(item =>
                 item.include && (item.area >= 20)
@@ -127,6 +144,16 @@ def get_web_element_rect(browser, fix_color=True):
             //}
             
 
+            // All boxes live in one container, attached once and removed with a single call
+            var container = document.createElement("div");
+            // out of the normal flow, otherwise it can shift flex / grid layouts after the rects were measured
+            container.style.position = "fixed";
+            container.style.top = "0";
+            container.style.left = "0";
+            container.style.pointerEvents = "none";
+            // being fixed it is its own stacking context, so it has to carry the top z-index for the boxes
+            container.style.zIndex = 2147483647;
+
             // Lets create a floating border on top of these elements that will always be visible
             items.forEach(function(item, index) {
                 item.rects.forEach((bbox) => {
@@ -158,72 +185,81 @@ def get_web_element_rect(browser, fix_color=True):
                 label.style.borderRadius = "2px";
                 newElement.appendChild(label);
                 
-                document.body.appendChild(newElement);
-                labels.push(newElement);
+                container.appendChild(newElement);
                 // item.element.setAttribute("-ai-label", label.textContent);
                 });
             })
+            document.body.appendChild(container);
 
             // For the first way
             // return [labels, items.map(item => ({
             //     rect: item.rects[0] // assuming there's at least one rect
             // }))];
 
+            // Text line of each listed element, built here so Python only receives the elements and one string
+            const inputTypes = new Set(inputAttrTypes);
+            const buttonTypes = new Set(["submit", "button"]);
+            const formTags = new Set(["button", "input", "textarea"]);
+            var eleTexts = [];
+            items.forEach(function(item, index) {
+                var text = item.text, tag = item.tagName, ariaLabel = item.ariaLabel;
+                if (!text) {
+                    if ((tag === "input" && inputTypes.has(item.type)) || tag === "textarea" || (tag === "button" && buttonTypes.has(item.type))) {
+                        eleTexts.push(`[${index}]: <${tag}> "${ariaLabel || text}";`);
+                    }
+                } else if (text.length < 200 && !/<img[^>]*src=/.test(text)) {
+                    var tagPrefix = formTags.has(tag) ? `<${tag}> ` : "";
+                    if (ariaLabel && ariaLabel !== text) {
+                        eleTexts.push(`[${index}]: ${tagPrefix}"${text}", "${ariaLabel}";`);
+                    } else {
+                        eleTexts.push(`[${index}]: ${tagPrefix}"${text}";`);
+                    }
+                }
+            });
+
             // For the second way
-            return [labels, items]
+            return [container, items.map(item => item.element), eleTexts.join("\t")]
         }
-        return markPage();""".replace("COLOR_FUNCTION", selected_function)
-    rects, items_raw = browser.execute_script(js_script)
-
-    # format_ele_text = [f"[{web_ele_id}]: \"{items_raw[web_ele_id]['text']}\";" for web_ele_id in range(len(items_raw)) if items_raw[web_ele_id]['text'] ]
-    format_ele_text = []
-    for web_ele_id in range(len(items_raw)):
-        label_text = items_raw[web_ele_id]['text']
-        ele_tag_name = items_raw[web_ele_id]['element'].tag_name
-        ele_type = items_raw[web_ele_id]['element'].get_attribute("type")
-        ele_aria_label = items_raw[web_ele_id]['element'].get_attribute("aria-label")
-        input_attr_types = ['text', 'search', 'password', 'email', 'tel']
-
-        if not label_text:
-            if (ele_tag_name.lower() == 'input' and ele_type in input_attr_types) or ele_tag_name.lower() == 'textarea' or (ele_tag_name.lower() == 'button' and ele_type in ['submit', 'button']):
-                if ele_aria_label:
-                    format_ele_text.append(f"[{web_ele_id}]: <{ele_tag_name}> \"{ele_aria_label}\";")
-                else:
-                    format_ele_text.append(f"[{web_ele_id}]: <{ele_tag_name}> \"{label_text}\";" )
-
-        elif label_text and len(label_text) < 200:
-            if not ("<img" in label_text and "src=" in label_text):
-                if ele_tag_name in ["button", "input", "textarea"]:
-                    if ele_aria_label and (ele_aria_label != label_text):
-                        format_ele_text.append(f"[{web_ele_id}]: <{ele_tag_name}> \"{label_text}\", \"{ele_aria_label}\";")
-                    else:
-                        format_ele_text.append(f"[{web_ele_id}]: <{ele_tag_name}> \"{label_text}\";")
-                else:
-                    if ele_aria_label and (ele_aria_label != label_text):
-                        format_ele_text.append(f"[{web_ele_id}]: \"{label_text}\", \"{ele_aria_label}\";")
-                    else:
-                        format_ele_text.append(f"[{web_ele_id}]: \"{label_text}\";")
-
-
-
-    format_ele_text = '\t'.join(format_ele_text)
-    return rects, [web_ele['element'] for web_ele in items_raw], format_ele_text
+        return markPage(arguments[0]);"""
+MARK_PAGE_SCRIPT_CACHE = {}
+
+# input types that accept typed text
+INPUT_ATTR_TYPES = frozenset(['text', 'search', 'password', 'email', 'tel'])
+
+
+# interact with webpage and add rectangles on elements
+def get_web_element_rect(browser, fix_color=True):
+    if fix_color:
+        selected_function = "getFixedColor"
+        # color_you_like = '#5210da'
+    else:
+        selected_function = "getRandomColor"
+
+    js_script = MARK_PAGE_SCRIPT_CACHE.get(selected_function)
+    if js_script is None:
+        js_script = MARK_PAGE_SCRIPT.replace("COLOR_FUNCTION", selected_function)
+        MARK_PAGE_SCRIPT_CACHE[selected_function] = js_script
+
+    rects, web_eles, format_ele_text = browser.execute_script(js_script, sorted(INPUT_ATTR_TYPES))
+    return rects, web_eles, format_ele_text
+
+
+# checked in order, the first matching action wins
+ACTION_PATTERNS = {
+    "click": re.compile(r"Click \[?(\d+)\]?"),
+    "type": re.compile(r"Type \[?(\d+)\]?[; ]+\[?(.[^\]]*)\]?"),
+    # "delete_and_type": re.compile(r"Delete_and_Type \[?(\d+)\]?[; ]+\[?(.[^\]]*)\]?"),
+    "scroll": re.compile(r"Scroll \[?(\d+|WINDOW)\]?[; ]+\[?(up|down)\]?"),
+    "wait": re.compile(r"^Wait"),
+    "goback": re.compile(r"^GoBack"),
+    "google": re.compile(r"^Google"),
+    "answer": re.compile(r"ANSWER[; ]+\[?(.[^\]]*)\]?")
+}
 
 
 def extract_information(text):
-    patterns = {
-        "click": r"Click \[?(\d+)\]?",
-        "type": r"Type \[?(\d+)\]?[; ]+\[?(.[^\]]*)\]?",
-        # "delete_and_type": r"Delete_and_Type \[?(\d+)\]?[; ]+\[?(.[^\]]*)\]?",
-        "scroll": r"Scroll \[?(\d+|WINDOW)\]?[; ]+\[?(up|down)\]?",
-        "wait": r"^Wait",
-        "goback": r"^GoBack",
-        "google": r"^Google",
-        "answer": r"ANSWER[; ]+\[?(.[^\]]*)\]?"
-    }
-
-    for key, pattern in patterns.items():
-        match = re.search(pattern, text)
+    for key, pattern in ACTION_PATTERNS.items():
+        match = pattern.search(text)
         if match:
             if key in ["click", "wait", "goback", "google"]:
                 # no content
@@ -346,6 +382,10 @@ def get_webarena_accessibility_tree(browser, save_file=None):
 
 
 def compare_images(img1_path, img2_path):
+    # numpy is not in requirements.txt, import lazily so run.py does not need it
+    import numpy as np
+    from PIL import Image
+
     img1 = Image.open(img1_path)
     img2 = Image.open(img2_path)
 